@@ -1,15 +1,17 @@
 import argparse
 import json
-import math
+import multiprocessing
 import os
-import random
 import re
+import threading
 import traceback
 from argparse import ArgumentParser
-from copy import deepcopy
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
 from gettext import gettext as _
 from multiprocessing import Pool, Queue
-from time import sleep
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 
 import numpy as np
 
@@ -23,47 +25,265 @@ try:
 except ModuleNotFoundError:
     pass
 
+# set by the pool initializers. Thread local so trials run by the thread
+# backend see the train function of their own pool
+_worker_state = threading.local()
 
-def optimize_parallel_gpu_private(args):
-    trial_params, train_function = args[0], args[1]
+
+def _imap_chunksize(nb_trials, nb_workers, chunksize='auto'):
+    """
+    Chunksize for imap_unordered. Kept smaller than the Pool.map heuristic
+    because trial durations vary a lot, so large chunks leave workers idle
+    :param nb_trials:
+    :param nb_workers:
+    :param chunksize: an int to force it or 'auto'
+    :return:
+    """
+    if chunksize != 'auto':
+        return chunksize
+
+    # with few trials per worker one slow chunk dominates the sweep, so hand
+    # out one trial at a time and let idle workers pick up the next one
+    if nb_trials < nb_workers * 8:
+        return 1
+    return max(1, nb_trials // (nb_workers * 4))
+
+
+class _LokyPool(object):
+    """
+    Exposes a loky executor through the subset of the Pool api used by the parser
+    """
+
+    def __init__(self, nb_workers, initializer=None, initargs=()):
+        from loky import ProcessPoolExecutor
+        self.executor = ProcessPoolExecutor(max_workers=nb_workers, initializer=initializer, initargs=initargs)
+        self.max_pending = 2 * nb_workers
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        # only keep a couple of tasks per worker in flight so a large sweep
+        # isn't pickled and queued all at once
+        iterable = iter(iterable)
+        pending = {self.executor.submit(func, x) for x in islice(iterable, self.max_pending)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for x in islice(iterable, len(done)):
+                pending.add(self.executor.submit(func, x))
+            for future in done:
+                yield future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def join(self):
+        self.executor.shutdown(wait=True)
+
+
+def _make_pool(backend, nb_workers, initializer=None, initargs=(), maxtasksperchild=None):
+    """
+    Builds a worker pool for the given backend
+    :param backend: 'stdlib' (multiprocessing.Pool), 'loky' or 'thread'
+    :param nb_workers:
+    :param initializer:
+    :param initargs:
+    :param maxtasksperchild: replace a worker after this many tasks, stdlib only
+    :return:
+    """
+    if maxtasksperchild is not None and backend != 'stdlib':
+        raise ValueError(
+            ('The {} backend can\'t recycle its workers. '
+             'Use max_trials_per_worker=None').format(backend))
+
+    if backend == 'stdlib':
+        return Pool(processes=nb_workers, initializer=initializer, initargs=initargs,
+                    maxtasksperchild=maxtasksperchild)
+    elif backend == 'loky':
+        return _LokyPool(nb_workers, initializer=initializer, initargs=initargs)
+    elif backend == 'thread':
+        return ThreadPool(processes=nb_workers, initializer=initializer, initargs=initargs)
+    else:
+        raise ValueError(
+            ('Unknown backend "{}". Must be one of '
+             '{{stdlib, loky, thread}}').format(backend))
+
+
+class _GpuIdSlots(object):
+    """
+    Hands out gpu id sets to the workers. The semaphore counts the free sets and
+    one lock per set marks it as taken, so a claim is a couple of semaphore ops
+    instead of a pickled round trip through a Queue pipe, and no two workers
+    ever get the same set
+    """
+
+    def __init__(self, gpu_ids, backend='stdlib'):
+        # locks have to come from the same multiprocessing context as the pool workers
+        if backend == 'loky':
+            from loky.backend.context import get_context
+            ctx = get_context('loky')
+        else:
+            ctx = multiprocessing.get_context()
+
+        self.gpu_ids = tuple(gpu_ids)
+        self.free = ctx.Semaphore(len(self.gpu_ids))
+        self.locks = [ctx.Lock() for _ in self.gpu_ids]
+
+    def claim(self):
+        # once the semaphore is passed at least one lock is guaranteed to be free
+        self.free.acquire()
+        while True:
+            for idx, lock in enumerate(self.locks):
+                if lock.acquire(False):
+                    return idx
+
+    def release(self, idx):
+        self.locks[idx].release()
+        self.free.release()
+
+
+def _init_cpu_worker(train_function):
+    """
+    Called by the Pool when a process starts. The train function is sent once
+    per worker instead of being pickled with every trial
+    :param train_function:
+    :return:
+    """
+    _worker_state.train_fn = train_function
+
+
+def _init_gpu_worker(gpu_slots, pin_gpu_ids, train_function, post_trial_cleanup=None):
+    """
+    Called by the Pool when a process starts
+    :param gpu_slots: _GpuIdSlots shared by the workers
+    :param pin_gpu_ids: when every worker can own a gpu id set, take one for the
+        lifetime of the worker instead of claiming one on every task
+    :param train_function:
+    :param post_trial_cleanup: callable run in the worker after every trial
+    :return:
+    """
+    global g_gpu_slots, g_pinned_gpu_id_set
+    g_gpu_slots = gpu_slots
+    _worker_state.train_fn = train_function
+    _worker_state.post_trial_cleanup = post_trial_cleanup
+    g_pinned_gpu_id_set = None
+
+    if pin_gpu_ids:
+        gpu_idx = gpu_slots.claim()
+        g_pinned_gpu_id_set = gpu_slots.gpu_ids[gpu_idx]
+        os.environ["CUDA_VISIBLE_DEVICES"] = g_pinned_gpu_id_set
+
+        # a worker the pool replaces hands its set over to its successor
+        Finalize(None, gpu_slots.release, args=(gpu_idx,), exitpriority=10)
+
+
+def _reserve_trial_nb(arg_names):
+    """
+    Fails before a sweep starts when an argument would be shadowed by the trial index
+    :param arg_names:
+    :return:
+    """
+    if 'trial_nb' in arg_names:
+        raise ValueError(
+            '"trial_nb" is reserved for the index of the trial in the sweep. '
+            'Rename the argument')
+
+
+def _numbered_namespace(trial_dict, trial_nb):
+    """
+    Namespace over trial_dict plus the index of the trial in the sweep
+    :param trial_dict: a dict the namespace can own, it isn't copied
+    :param trial_nb:
+    :return:
+    """
+    trial_dict['trial_nb'] = trial_nb
+    ns = TTNamespace()
+    ns.__dict__ = trial_dict
+    return ns
+
+
+def _batch_trials(trials, batch_size):
+    trials = iter(trials)
+    batch = list(islice(trials, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(trials, batch_size))
+
+
+def optimize_parallel_gpu_private(trial_batch):
+    # pinned workers already have their gpus enabled
+    if g_pinned_gpu_id_set is not None:
+        return _run_gpu_trial_batch(trial_batch, _worker_state.train_fn, g_pinned_gpu_id_set)
 
     # get set of gpu ids
-    gpu_id_set = g_gpu_id_q.get(block=True)
+    gpu_idx = g_gpu_slots.claim()
+    gpu_id_set = g_gpu_slots.gpu_ids[gpu_idx]
 
     try:
 
-        # enable the proper gpus
+        # enable the proper gpus once for the whole batch
         os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id_set
+        return _run_gpu_trial_batch(trial_batch, _worker_state.train_fn, gpu_id_set)
 
-        # run training fx on the specific gpus
-        results = train_function(trial_params, gpu_id_set)
+    finally:
+        g_gpu_slots.release(gpu_idx)
 
-        return [trial_params, results]
 
-    except Exception as e:
-        print('Caught exception in worker thread', e)
+def _run_gpu_trial_batch(trial_batch, train_function, gpu_id_set):
+    batch_results = []
+    for trial_params in trial_batch:
+        try:
+            # run training fx on the specific gpus
+            results = train_function(trial_params, gpu_id_set)
+            batch_results.append([trial_params, results])
 
-        # This prints the type, value, and stack trace of the
-        # current exception being handled.
-        traceback.print_exc()
-        return [trial_params, None]
+        except Exception as e:
+            print('Caught exception in worker thread', e)
 
-    finally:
-        g_gpu_id_q.put(gpu_id_set)
+            # This prints the type, value, and stack trace of the
+            # current exception being handled.
+            traceback.print_exc()
+            batch_results.append([trial_params, None])
+
+        finally:
+            _post_trial_cleanup()
 
+    return batch_results
 
-def optimize_parallel_cpu_private(args):
-    trial_params, train_function = args[0], args[1]
 
-    sleep(random.randint(0, 4))
+def _post_trial_cleanup():
+    cleanup = getattr(_worker_state, 'post_trial_cleanup', None)
+    if cleanup is None:
+        return
 
+    try:
+        cleanup()
+    except Exception as e:
+        print('Caught exception in post trial cleanup', e)
+        traceback.print_exc()
+
+
+def optimize_parallel_cpu_private(trial_params):
     # run training fx on the specific gpus
-    results = train_function(trial_params)
+    results = _worker_state.train_fn(trial_params)
 
     # True = completed
     return [trial_params, results]
 
 
+def optimize_parallel_fork_private(trial_q, train_function, worker_nb):
+    # run trials back to back until the parent sends the sentinel
+    while True:
+        trial_params = trial_q.get(block=True)
+        if trial_params is None:
+            return
+
+        # a trial calling sys.exit or interrupted by ctrl-c only loses that trial
+        try:
+            train_function(trial_params, worker_nb)
+
+        except BaseException as e:
+            print('Caught exception in worker process', e)
+            traceback.print_exc()
+
+
 class HyperOptArgumentParser(ArgumentParser):
     """
     Subclass of argparse ArgumentParser which adds optional calls to sample from lists or ranges
@@ -82,10 +302,11 @@ class HyperOptArgumentParser(ArgumentParser):
         SLURM_LOAD_CMD: bool
     }
 
-    def __init__(self, strategy='grid_search', **kwargs):
+    def __init__(self, strategy='grid_search', seed=None, **kwargs):
         """
 
         :param strategy: 'grid_search', 'random_search'
+        :param seed: seed for the values sampled by opt_range
         :param enabled:
         :param experiment:
         :param kwargs:
@@ -93,16 +314,27 @@ class HyperOptArgumentParser(ArgumentParser):
         ArgumentParser.__init__(self, **kwargs)
 
         self.strategy = strategy
+        self._rng = np.random.default_rng(seed)
+        self._log_sampler = _LogRangeSampler(self._rng)
         self.trials = []
         self.parsed_args = None
+        self._ns_template = None
         self.opt_args = {}
+        self._flat_params_cache = None
         self.json_config_arg_name = None
+        self._pools = {}
+
+        # the pool used by the last optimize_parallel_gpu/cpu call
         self.pool = None
 
     def __getstate__(self):
         # capture what is normally pickled
         state = self.__dict__.copy()
 
+        # worker pools can't be pickled
+        state['_pools'] = {}
+        state['pool'] = None
+
         # remove all functions from the namespace
         clean_state = {}
         for k, v in state.items():
@@ -116,6 +348,94 @@ class HyperOptArgumentParser(ArgumentParser):
         # re-instate our __dict__ state from the pickled state
         self.__dict__.update(newstate)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Shuts down the worker pools kept alive between optimize_parallel_* calls
+        :return:
+        """
+        for pool, _ in self._pools.values():
+            pool.close()
+            pool.join()
+        self._pools = {}
+        self.pool = None
+
+    def _get_pool(self, key, worker_fns):
+        """
+        Returns the pool stored under key so the fork + import cost of the workers
+        is paid once per sweep. Workers keep the functions they were started
+        with, so a pool started for other functions is shut down instead. The
+        functions are compared with ==, so a lambda or functools.partial built
+        anew for every call never reuses a pool
+        :param key: tuple identifying the kind of pool
+        :param worker_fns: the functions handed to the worker initializer
+        :return: the pool or None
+        """
+        if key not in self._pools:
+            return None
+
+        pool, pool_worker_fns = self._pools[key]
+        if pool_worker_fns != worker_fns:
+            pool.close()
+            pool.join()
+            del self._pools[key]
+            return None
+
+        return pool
+
+    def _ensure_cpu_pool(self, train_function, nb_workers, backend='stdlib'):
+        key = ('cpu', nb_workers, backend)
+        pool = self._get_pool(key, train_function)
+        if pool is None:
+            pool = _make_pool(backend, nb_workers, _init_cpu_worker, (train_function,))
+            self._pools[key] = (pool, train_function)
+        self.pool = pool
+        return pool
+
+    def _ensure_gpu_pool(
+            self,
+            train_function,
+            gpu_ids,
+            nb_workers,
+            backend='stdlib',
+            max_trials_per_worker=None,
+            post_trial_cleanup=None
+    ):
+        if backend == 'thread':
+            raise ValueError('CUDA_VISIBLE_DEVICES is per process, gpu trials need a process backend')
+
+        key = ('gpu', nb_workers, tuple(gpu_ids), backend, max_trials_per_worker)
+        worker_fns = (train_function, post_trial_cleanup)
+        pool = self._get_pool(key, worker_fns)
+        if pool is None:
+            # share the gpu ids with each process
+            # each process claims a free gpu id set, runs its task and releases it when done
+            gpu_slots = _GpuIdSlots(gpu_ids, backend)
+
+            # pin each worker to its own gpu id set when there are enough to go around.
+            # recycled workers claim per task instead. loky also replaces workers on
+            # its own, e.g. when their memory grows, so its workers never pin
+            pin_gpu_ids = (
+                max_trials_per_worker is None
+                and backend == 'stdlib'
+                and nb_workers <= len(gpu_ids)
+            )
+            pool = _make_pool(
+                backend,
+                nb_workers,
+                _init_gpu_worker,
+                (gpu_slots, pin_gpu_ids, train_function, post_trial_cleanup),
+                maxtasksperchild=max_trials_per_worker
+            )
+            self._pools[key] = (pool, worker_fns)
+        self.pool = pool
+        return pool
+
     def add_argument(self, *args, **kwargs):
         super(HyperOptArgumentParser, self).add_argument(*args, **kwargs)
 
@@ -126,6 +446,7 @@ class HyperOptArgumentParser(ArgumentParser):
         for i in range(len(args)):
             arg_name = args[i]
             self.opt_args[arg_name] = OptArg(obj_id=arg_name, opt_values=options, tunable=tunable)
+        self._flat_params_cache = None
 
     def opt_range(
             self,
@@ -148,11 +469,14 @@ class HyperOptArgumentParser(ArgumentParser):
             nb_samples=nb_samples,
             tunable=tunable,
             log_base=log_base,
+            rng=self._rng,
+            log_sampler=self._log_sampler,
         )
+        self._flat_params_cache = None
 
     def json_config(self, *args, **kwargs):
         self.add_argument(*args, **kwargs)
-        self.json_config_arg_name = re.sub('-', '', args[-1])
+        self.json_config_arg_name = args[-1].replace('-', '')
 
     def __parse_args(self, args=None, namespace=None):
         # allow bypassing certain missing params which other parts of test tube may introduce
@@ -247,16 +571,13 @@ class HyperOptArgumentParser(ArgumentParser):
                 old_args[arg] = v
 
         # track args
-        self.parsed_args = deepcopy(old_args)
-        # attach optimization fx
-        old_args['trials'] = self.opt_trials
-        old_args['optimize_parallel'] = self.optimize_parallel
-        old_args['optimize_parallel_gpu'] = self.optimize_parallel_gpu
-        old_args['optimize_parallel_cpu'] = self.optimize_parallel_cpu
-        old_args['generate_trials'] = self.generate_trials
-        old_args['optimize_trials_parallel_gpu'] = self.optimize_trials_parallel_gpu
+        self.parsed_args = dict(old_args)
+        self._ns_template = dict(self.parsed_args)
 
-        return TTNamespace(**old_args)
+        # the optimization fx are looked up on the parser when accessed
+        ns = TTNamespace(**old_args)
+        ns._parser = self
+        return ns
 
     def __read_json_config(self, file_path):
         with open(file_path) as json_data:
@@ -264,22 +585,14 @@ class HyperOptArgumentParser(ArgumentParser):
             return json_args
 
     def opt_trials(self, num):
-        self.trials = strategies.generate_trials(
-            strategy=self.strategy,
-            flat_params=self.__flatten_params(self.opt_args),
-            nb_trials=num,
-        )
+        self.trials = self.__generate_trial_idxs(num)
 
         for trial in self.trials:
             ns = self.__namespace_from_trial(trial)
             yield ns
 
     def generate_trials(self, nb_trials):
-        trials = strategies.generate_trials(
-            strategy=self.strategy,
-            flat_params=self.__flatten_params(self.opt_args),
-            nb_trials=nb_trials,
-        )
+        trials = self.__generate_trial_idxs(nb_trials)
 
         trials = [self.__namespace_from_trial(x) for x in trials]
         return trials
@@ -289,40 +602,59 @@ class HyperOptArgumentParser(ArgumentParser):
             train_function,
             gpu_ids,
             max_nb_trials=None,
+            backend='stdlib',
+            batch_per_gpu=1,
+            chunksize='auto',
+            max_trials_per_worker=None,
+            post_trial_cleanup=None,
     ):
         """
         Runs optimization across gpus with cuda drivers
         :param train_function:
         :param max_nb_trials:
         :param gpu_ids: List of strings like: ['0', '1, 3']
+        :param backend: 'stdlib' or 'loky' (cheaper dispatch for short trials, needs loky installed)
+        :param batch_per_gpu: nb of trials run back to back each time a gpu id set is claimed
+        :param chunksize: nb of tasks sent to a worker at once, 'auto' picks 1 when there are
+            few trials per worker so fast workers never wait on a straggler
+        :param max_trials_per_worker: replace a worker process after this many tasks
+            (batch_per_gpu trials each) so memory leaked by a trial, like a CUDA context,
+            can't pile up. None, the default, keeps the workers for the whole sweep.
+            stdlib backend only
+        :param post_trial_cleanup: callable run in the worker after every trial,
+            e.g. torch.cuda.empty_cache
         :return:
         """
-        self.trials = strategies.generate_trials(
-            strategy=self.strategy,
-            flat_params=self.__flatten_params(self.opt_args),
-            nb_trials=max_nb_trials,
-        )
+        _reserve_trial_nb(self._ns_template)
+        self.trials = self.__generate_trial_idxs(max_nb_trials)
 
-        self.trials = [(self.__namespace_from_trial(x), train_function) for x in self.trials]
+        # namespaces are built lazily while the pool consumes the batches
+        trial_namespaces = (self.__namespace_from_trial(x, trial_nb=i) for i, x in enumerate(self.trials))
+        trial_batches = _batch_trials(trial_namespaces, batch_per_gpu)
+        nb_batches = -(-len(self.trials) // batch_per_gpu)
 
-        # build q of gpu ids so we can use them in each process
-        # this is thread safe so each process can pull out a gpu id, run its task and put it back when done
-        if self.pool is None:
-            gpu_q = Queue()
-            for gpu_id in gpu_ids:
-                gpu_q.put(gpu_id)
+        # one worker per gpu id set
+        nb_workers = len(gpu_ids)
 
-            # called by the Pool when a process starts
-            def init(local_gpu_q):
-                global g_gpu_id_q
-                g_gpu_id_q = local_gpu_q
+        # init a pool with the nb of worker threads we want
+        pool = self._ensure_gpu_pool(
+            train_function,
+            gpu_ids,
+            nb_workers,
+            backend=backend,
+            max_trials_per_worker=max_trials_per_worker,
+            post_trial_cleanup=post_trial_cleanup
+        )
 
-            # init a pool with the nb of worker threads we want
-            nb_workers = len(gpu_ids)
-            self.pool = Pool(processes=nb_workers, initializer=init, initargs=(gpu_q,))
+        # a recycled worker counts chunks, not batches, so send them one at a time
+        if max_trials_per_worker is not None and chunksize == 'auto':
+            chunksize = 1
 
-        # apply parallelization
-        results = self.pool.map(optimize_parallel_gpu_private, self.trials)
+        # apply parallelization, collecting results as soon as each trial finishes
+        chunksize = _imap_chunksize(nb_batches, nb_workers, chunksize)
+        results = []
+        for batch_results in pool.imap_unordered(optimize_parallel_gpu_private, trial_batches, chunksize):
+            results.extend(batch_results)
         return results
 
     def optimize_trials_parallel_gpu(
@@ -332,6 +664,11 @@ class HyperOptArgumentParser(ArgumentParser):
             trials,
             gpu_ids,
             nb_workers=4,
+            backend='stdlib',
+            batch_per_gpu=1,
+            chunksize='auto',
+            max_trials_per_worker=None,
+            post_trial_cleanup=None,
     ):
         """
         Runs optimization across gpus with cuda drivers
@@ -339,28 +676,46 @@ class HyperOptArgumentParser(ArgumentParser):
         :param nb_trials:
         :param gpu_ids: List of strings like: ['0', '1, 3']
         :param nb_workers:
+        :param backend: 'stdlib' or 'loky' (cheaper dispatch for short trials, needs loky installed)
+        :param batch_per_gpu: nb of trials run back to back each time a gpu id set is claimed
+        :param chunksize: nb of tasks sent to a worker at once, 'auto' picks 1 when there are
+            few trials per worker so fast workers never wait on a straggler
+        :param max_trials_per_worker: replace a worker process after this many tasks
+            (batch_per_gpu trials each) so memory leaked by a trial, like a CUDA context,
+            can't pile up. None, the default, keeps the workers for the whole sweep.
+            stdlib backend only
+        :param post_trial_cleanup: callable run in the worker after every trial,
+            e.g. torch.cuda.empty_cache
         :return:
         """
+        for trial in trials:
+            _reserve_trial_nb(vars(trial))
         self.trials = trials
-        self.trials = [(x, train_function) for x in self.trials]
 
-        # build q of gpu ids so we can use them in each process
-        # this is thread safe so each process can pull out a gpu id, run its task and put it back when done
-        if self.pool is None:
-            gpu_q = Queue()
-            for gpu_id in gpu_ids:
-                gpu_q.put(gpu_id)
+        # number copies of the trials, the caller's namespaces are left untouched
+        trial_namespaces = (_numbered_namespace(dict(vars(x)), i) for i, x in enumerate(self.trials))
+        trial_batches = _batch_trials(trial_namespaces, batch_per_gpu)
+        nb_batches = -(-len(self.trials) // batch_per_gpu)
 
-            # called by the Pool when a process starts
-            def init(local_gpu_q):
-                global g_gpu_id_q
-                g_gpu_id_q = local_gpu_q
+        # init a pool with the nb of worker threads we want
+        pool = self._ensure_gpu_pool(
+            train_function,
+            gpu_ids,
+            nb_workers,
+            backend=backend,
+            max_trials_per_worker=max_trials_per_worker,
+            post_trial_cleanup=post_trial_cleanup
+        )
 
-            # init a pool with the nb of worker threads we want
-            self.pool = Pool(processes=nb_workers, initializer=init, initargs=(gpu_q,))
+        # a recycled worker counts chunks, not batches, so send them one at a time
+        if max_trials_per_worker is not None and chunksize == 'auto':
+            chunksize = 1
 
-        # apply parallelization
-        results = self.pool.map(optimize_parallel_gpu_private, self.trials)
+        # apply parallelization, collecting results as soon as each trial finishes
+        chunksize = _imap_chunksize(nb_batches, nb_workers, chunksize)
+        results = []
+        for batch_results in pool.imap_unordered(optimize_parallel_gpu_private, trial_batches, chunksize):
+            results.extend(batch_results)
         return results
 
     def optimize_parallel_cpu(
@@ -368,28 +723,37 @@ class HyperOptArgumentParser(ArgumentParser):
             train_function,
             nb_trials,
             nb_workers=4,
+            backend='stdlib',
+            chunksize='auto',
     ):
         """
         Runs optimization across n cpus
         :param train_function:
         :param nb_trials:
         :param nb_workers:
+        :param backend: 'stdlib' or 'loky' (cheaper dispatch for short trials, needs loky installed).
+            'thread' runs the trials on threads of this process, which skips the pickling of
+            trials and results. Only worth it when train_function is I/O bound (launching
+            subprocesses, remote calls...) since the trials share the GIL
+        :param chunksize: nb of trials sent to a worker at once, 'auto' picks 1 when there are
+            few trials per worker so fast workers never wait on a straggler
         :return:
         """
-        self.trials = strategies.generate_trials(
-            strategy=self.strategy,
-            flat_params=self.__flatten_params(self.opt_args),
-            nb_trials=nb_trials
-        )
+        _reserve_trial_nb(self._ns_template)
+        self.trials = self.__generate_trial_idxs(nb_trials)
 
-        self.trials = [(self.__namespace_from_trial(x), train_function) for x in self.trials]
+        # namespaces are built lazily while the pool consumes them
+        # number the trials so workers can keep their logs apart without racing
+        trial_namespaces = (self.__namespace_from_trial(x, trial_nb=i) for i, x in enumerate(self.trials))
 
         # init a pool with the nb of worker threads we want
-        if self.pool is None:
-            self.pool = Pool(processes=nb_workers)
+        pool = self._ensure_cpu_pool(train_function, nb_workers, backend=backend)
 
-        # apply parallelization
-        results = self.pool.map(optimize_parallel_cpu_private, self.trials)
+        # apply parallelization, collecting results as soon as each trial finishes
+        chunksize = _imap_chunksize(len(self.trials), nb_workers, chunksize)
+        results = []
+        for result in pool.imap_unordered(optimize_parallel_cpu_private, trial_namespaces, chunksize):
+            results.append(result)
         return results
 
     def optimize_parallel(
@@ -398,71 +762,123 @@ class HyperOptArgumentParser(ArgumentParser):
             nb_trials,
             nb_parallel=4,
     ):
-        self.trials = strategies.generate_trials(
-            strategy=self.strategy,
-            flat_params=self.__flatten_params(self.opt_args),
-            nb_trials=nb_trials
-        )
-
-        # nb of runs through all parallel systems
-        fork_batches = [
-            self.trials[i:i + nb_parallel] for i in range(0, len(self.trials), nb_parallel)
-        ]
-
-        for fork_batch in fork_batches:
-            children = []
-
-            # run n parallel forks
-            for parallel_nb, trial in enumerate(fork_batch):
-
-                # q up the trial and convert to a namespace
-                ns = self.__namespace_from_trial(trial)
+        _reserve_trial_nb(self._ns_template)
+        self.trials = self.__generate_trial_idxs(nb_trials)
 
-                # split new fork
-                pid = os.fork()
+        # fork the workers once, they pull trials from the q until they see a sentinel
+        trial_q = Queue()
+        nb_workers = min(nb_parallel, len(self.trials))
+        children = []
+        for worker_nb in range(nb_workers):
 
-                # when the process is a parent
-                if pid:
-                    children.append(pid)
+            # split new fork
+            pid = os.fork()
 
-                # when process is a child
-                else:
-                    # slight delay to make sure we don't overwrite over test tube log versions
-                    sleep(parallel_nb * 0.5)
-                    train_function(ns, parallel_nb)
-                    os._exit(0)
-
-            for i, child in enumerate(children):
-                os.waitpid(child, 0)
-
-    def __namespace_from_trial(self, trial):
-        trial_dict = {d['name']: d['val'] for d in trial}
-        for k, v in self.parsed_args.items():
-            if k not in trial_dict:
-                trial_dict[k] = v
+            # when the process is a parent
+            if pid:
+                children.append(pid)
 
-        return TTNamespace(**trial_dict)
-
-    def __flatten_params(self, params):
+            # when process is a child
+            # the child must never return into the parent's code, whatever it raises
+            else:
+                exit_code = 1
+                try:
+                    optimize_parallel_fork_private(trial_q, train_function, worker_nb)
+                    exit_code = 0
+                finally:
+                    os._exit(exit_code)
+
+        # q up the trials as namespaces, then one sentinel per worker
+        for i, trial in enumerate(self.trials):
+            trial_q.put(self.__namespace_from_trial(trial, trial_nb=i))
+        for _ in range(nb_workers):
+            trial_q.put(None)
+
+        # every worker drains the same q so they finish together, waiting on them in
+        # order adds no latency. waitpid(-1) would also reap the workers of our pools
+        for child in children:
+            _, status = os.waitpid(child, 0)
+            if os.WIFSIGNALED(status):
+                print('Worker process {} was killed by signal {}'.format(child, os.WTERMSIG(status)))
+
+    def __namespace_from_trial(self, trial, trial_nb=None):
+        names, values = self.__flatten_params()
+
+        # start from the parsed args and override the sampled values
+        trial_dict = self._ns_template.copy()
+        for name, param_values, idx in zip(names, values, trial):
+            trial_dict[name] = param_values[idx]
+
+        # unique index of the trial within the sweep
+        if trial_nb is not None:
+            return _numbered_namespace(trial_dict, trial_nb)
+
+        # assign the dict directly instead of a setattr per arg
+        ns = TTNamespace()
+        ns.__dict__ = trial_dict
+        return ns
+
+    def __generate_trial_idxs(self, nb_trials):
         """
-        Turns a list of parameters with values into a flat tuple list of lists
-        so we can permute
-        :param params:
+        Runs the search strategy over the indices of the tunable values. Each trial
+        is a tuple with one value index per tunable param
+        :param nb_trials:
         :return:
         """
-        flat_params = []
-        for i, (opt_name, opt_arg) in enumerate(params.items()):
-            if opt_arg.tunable:
-                clean_name = opt_name.strip('-')
-                clean_name = re.sub('-', '_', clean_name)
-                param_groups = []
-                for val in opt_arg.opt_values:
-                    param_groups.append({'idx': i, 'val': val, 'name': clean_name})
-                flat_params.append(param_groups)
-        return flat_params
+        _, values = self.__flatten_params()
+        flat_idxs = [list(range(len(param_values))) for param_values in values]
+        return strategies.generate_trials(
+            strategy=self.strategy,
+            flat_params=flat_idxs,
+            nb_trials=nb_trials,
+        )
+
+    def __flatten_params(self):
+        """
+        Splits the tunable opt args into a tuple with their clean names and a
+        list with the candidate values of each one.
+        The result is cached until opt_list/opt_range change the opt args
+        :return: (names, values)
+        """
+        if self._flat_params_cache is None:
+            names = []
+            values = []
+            for opt_name, opt_arg in self.opt_args.items():
+                if opt_arg.tunable:
+                    clean_name = opt_name.strip('-')
+                    clean_name = clean_name.replace('-', '_')
+                    names.append(clean_name)
+                    values.append(opt_arg.opt_values)
+            self._flat_params_cache = (tuple(names), values)
+
+        return self._flat_params_cache
 
 
 class TTNamespace(argparse.Namespace):
+    # kept out of __dict__ so it never shows up as a hyperparameter
+    __slots__ = ('_parser',)
+
+    # optimization fx of the parser reachable from the namespace
+    PARSER_METHODS = {
+        'trials': 'opt_trials',
+        'optimize_parallel': 'optimize_parallel',
+        'optimize_parallel_gpu': 'optimize_parallel_gpu',
+        'optimize_parallel_cpu': 'optimize_parallel_cpu',
+        'generate_trials': 'generate_trials',
+        'optimize_trials_parallel_gpu': 'optimize_trials_parallel_gpu',
+    }
+
+    def __getattr__(self, name):
+        # only called when name is not a hyperparameter
+        if name in TTNamespace.PARSER_METHODS:
+            try:
+                parser = self._parser
+            except AttributeError:
+                pass
+            else:
+                return getattr(parser, TTNamespace.PARSER_METHODS[name])
+
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
 
     def __str__(self):
         result = '-' * 100 + '\nHyperparameters:\n'
@@ -497,11 +913,21 @@ class OptArg(object):
             nb_samples=None,
             tunable=False,
             log_base=None,
+            rng=None,
+            log_sampler=None,
     ):
+        """
+        :param log_sampler: when given, log-scale values are drawn by the sampler together
+            with the other pending log-scale ranges the first time opt_values is read
+        """
+        self._log_sampler = None
         self.opt_values = opt_values
         self.obj_id = obj_id
         self.tunable = tunable
 
+        if rng is None:
+            rng = np.random.default_rng()
+
         # convert range to list of values
         if nb_samples:
             low, high = opt_values
@@ -509,14 +935,61 @@ class OptArg(object):
             if log_base is None:
                 # random search on uniform scale
                 if arg_type is int:
-                    self.opt_values = [int(_) for _ in np.random.choice(np.arange(low, high), nb_samples, replace=False)]
+                    self.opt_values = [int(_) for _ in rng.choice(np.arange(low, high), nb_samples, replace=False)]
                 elif arg_type is float:
-                    self.opt_values = np.random.uniform(low, high, nb_samples)
+                    self.opt_values = rng.uniform(low, high, nb_samples)
             else:
                 # random search on log scale with specified base
                 assert high >= low > 0, "`opt_values` must be positive to do log-scale search."
 
-                log_low, log_high = math.log(low, log_base), math.log(high, log_base)
+                if log_sampler is not None:
+                    self.nb_samples = nb_samples
+                    self._log_sampler = log_sampler
+                    log_sampler.add(self)
+                else:
+                    # log-uniform samples don't depend on the base, so draw the exponents in
+                    # natural log space and map them back with exp instead of a generic pow
+                    log_low, log_high = np.log(low), np.log(high)
+
+                    self.opt_values = np.exp(rng.uniform(log_low, log_high, nb_samples))
+
+    @property
+    def opt_values(self):
+        if self._log_sampler is not None:
+            self._log_sampler.sample()
+        return self._opt_values
+
+    @opt_values.setter
+    def opt_values(self, values):
+        self._opt_values = values
+        self._log_sampler = None
+
+
+class _LogRangeSampler(object):
+    """
+    Collects the log-scale opt_range declarations and draws the values of all of
+    them with a single rng call the first time one of them is needed
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.pending = []
+
+    def add(self, opt_arg):
+        self.pending.append(opt_arg)
+
+    def sample(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        # one (low, high) pair per sample, in log space
+        nb_samples = [opt_arg.nb_samples for opt_arg in pending]
+        bounds = np.log([opt_arg._opt_values for opt_arg in pending])
+        log_low = np.repeat(bounds[:, 0], nb_samples)
+        log_high = np.repeat(bounds[:, 1], nb_samples)
 
-                self.opt_values = log_base ** np.random.uniform(log_low, log_high, nb_samples)
+        samples = np.exp(self.rng.uniform(log_low, log_high))
+        for opt_arg, values in zip(pending, np.split(samples, np.cumsum(nb_samples)[:-1])):
+            opt_arg.opt_values = values
 
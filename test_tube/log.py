@@ -1,20 +1,44 @@
+import atexit
 import contextlib
+import csv
 from pathlib import Path
 import json
+import numbers
 import os
-import shutil
-from datetime import datetime
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import numpy as np
 import pandas as pd
 from imageio import imwrite
 from tensorboard.compat.proto.event_pb2 import Event
 from tensorboard.compat.proto.event_pb2 import SessionLog
+from tensorboard.compat.proto.summary_pb2 import Summary
 from torch.utils.tensorboard import SummaryWriter, FileWriter
 
+# faster json when available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# faster csv reading when available
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
 # constants
 _ROOT = os.path.abspath(os.path.dirname(__file__))
 
+# metric keys holding one of these are images, first match wins
+_IMG_MARKERS = (('jpeg', 'jpeg'), ('jpg', 'jpg'), ('png_', 'png'))
+
 # -----------------------------
 # Experiment object
 # -----------------------------
@@ -46,6 +70,9 @@ class DDPExperiment(object):
         self.debug = exp.debug
         self.version = exp.version
         self.autosave = exp.autosave
+        self.autosave_interval_secs = exp.autosave_interval_secs
+        self.tb_log_interval = exp.tb_log_interval
+        self.metrics_format = exp.metrics_format
         self.description = exp.description
         self.create_git_tag = exp.create_git_tag
         self.exp_hash = exp.exp_hash
@@ -61,11 +88,20 @@ class DDPExperiment(object):
             save_dir=self.save_dir,
             autosave=self.autosave,
             description=self.description,
-            create_git_tag=self.create_git_tag
+            create_git_tag=self.create_git_tag,
+            autosave_interval_secs=self.autosave_interval_secs,
+            tb_log_interval=self.tb_log_interval,
+            metrics_format=self.metrics_format
         )
 
 class Experiment(SummaryWriter):
 
+    # (pid, log_dir) -> [FileWriter, nb of experiments using it], so experiments
+    # sharing a log dir in this process write one event file. A forked child
+    # doesn't have the writer threads of its parent so it opens its own
+    _writer_cache = {}
+    _writer_cache_lock = threading.Lock()
+
     def __init__(
         self,
         save_dir=None,
@@ -76,6 +112,9 @@ class Experiment(SummaryWriter):
         description=None,
         create_git_tag=False,
         rank=0,
+        autosave_interval_secs=5,
+        tb_log_interval=1,
+        metrics_format='csv',
         *args, **kwargs
     ):
         """
@@ -83,7 +122,20 @@ class Experiment(SummaryWriter):
         If a known name is already provided, then the file version is changed
         :param name:
         :param debug:
+        :param autosave_interval_secs: with autosave, log and tag save at most this often.
+            Whatever is left is saved on close or when the interpreter exits
+        :param tb_log_interval: log() only writes to tensorboard on steps that are a
+            multiple of this. metrics.csv still gets every row
+        :param metrics_format: 'csv' or 'parquet' (zstd compressed, needs pyarrow).
+            metrics.parquet is only updated when the experiment is closed
         """
+        if metrics_format not in ('csv', 'parquet'):
+            raise ValueError(
+                ('Unknown metrics_format "{}". Must be one of '
+                 '{{csv, parquet}}').format(metrics_format))
+        if metrics_format == 'parquet':
+            # fail here rather than on the first save when pyarrow is missing
+            import pyarrow.parquet
 
         # change where the save dir is if requested
 
@@ -94,12 +146,16 @@ class Experiment(SummaryWriter):
         self.save_dir = save_dir
         self.tag_markdown_saved = False
         self.no_save_dir = save_dir is None
+        self._path_cache = {}
         self.metrics = []
         self.tags = {}
         self.name = name
         self.debug = debug
         self.version = version
         self.autosave = autosave
+        self.autosave_interval_secs = autosave_interval_secs
+        self.tb_log_interval = tb_log_interval
+        self.metrics_format = metrics_format
         self.description = description
         self.create_git_tag = create_git_tag
         self.exp_hash = '{}_v{}'.format(self.name, version)
@@ -107,6 +163,27 @@ class Experiment(SummaryWriter):
         self.rank = rank
         self.process = os.getpid()
 
+        # what is already on disk, so save only writes what changed
+        self._meta_dirty = True
+        self._tags_dirty = True
+        self._metrics_written = 0
+        self._metrics_columns = None
+        self._metrics_queued = 0
+        self._csv_fh = None
+        self._csv_writer = None
+        self._pq_writer = None
+        self._pq_commit = None
+        self._last_save = float('-inf')
+
+        # image extension (or None) of every metric key seen so far
+        self._img_extensions = {}
+
+        # files are written by one background thread so log() doesn't block on disk.
+        # a single worker keeps the saves in order
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+        self._save_error = None
+
         # when debugging don't do anything else
         if debug:
             return
@@ -127,12 +204,14 @@ class Experiment(SummaryWriter):
 
             # when no version and no file, create it
             if not os.path.exists(self.__get_log_name()):
-                self.__create_exp_file(self.version)
+                self.__create_exp_file(self.version, auto_version=version is None)
             else:
                 # otherwise load it
                 try:
                     self.__load()
                 except Exception as e:
+                    warnings.warn("Can't load the experiment {} ({}), nothing will be saved".format(
+                        self.__get_log_name(), e))
                     self.debug = True
         else:
             # if no version given, increase the version to a new exp
@@ -160,8 +239,10 @@ class Experiment(SummaryWriter):
                 setattr(self, attr, val)
         super().__init__(log_dir=log_dir, *args, **kwargs)
 
-        # register on exit fx so we always close the writer
-        # atexit.register(self.on_exit)
+        # register on exit fx so the last throttled autosave is not lost
+        # and the parquet file gets its footer
+        if self.autosave or self.metrics_format == 'parquet':
+            atexit.register(self.on_exit)
 
     def get_meta_copy(self):
         """
@@ -171,7 +252,27 @@ class Experiment(SummaryWriter):
         return DDPExperiment(self)
 
     def on_exit(self):
-        pass
+        # save what autosave held back
+        if self.autosave and (self._tags_dirty or self._metrics_queued < len(self.metrics)):
+            self.save()
+
+        # a parquet file can only be read once its writer is closed
+        if self.metrics_format == 'parquet' and not self.debug:
+            self.flush()
+            self.__close_parquet()
+
+    def close(self):
+        atexit.unregister(self.on_exit)
+        try:
+            self.on_exit()
+            self.flush()
+        finally:
+            # a failed save is raised, but the files are released either way
+            self._io_pool.shutdown(wait=True)
+            self.__close_csv()
+            self.__close_parquet()
+            self.__release_file_writer()
+            super().close()
 
 
     def __clean_dir(self):
@@ -222,28 +323,35 @@ class Experiment(SummaryWriter):
             # file already exists (likely written by another exp. In this case disable the experiment
             self.debug = True
 
-    def __create_exp_file(self, version):
+    def __create_exp_file(self, version, auto_version=False):
         """
         Recreates the old file with this exp and version
         :param version:
+        :param auto_version: the version was picked by us, so if another process
+            creates it first move on to the next one
         :return:
         """
+        while True:
+            try:
+                # the media and tensorboardx dirs make the version dir too
+                os.makedirs(self.get_media_path(self.name, version), exist_ok=True)
+                os.makedirs(self.get_tensorboardx_path(self.name, version), exist_ok=True)
+
+                # if no exp, then make it. O_EXCL tells us if someone else just did
+                path = '{}/meta.experiment'.format(self.get_data_path(self.name, version))
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                os.close(fd)
+            except FileExistsError:
+                if auto_version:
+                    version += 1
+                    continue
+            except OSError:
+                # can't write the exp. In this case disable the experiment
+                self.debug = True
+            break
 
-        try:
-            exp_cache_file = self.get_data_path(self.name, self.version)
-            # if no exp, then make it
-            path = '{}/meta.experiment'.format(exp_cache_file)
-            open(path, 'w').close()
-            self.version = version
-
-            # make the directory for the experiment media assets name
-            os.makedirs(self.get_media_path(self.name, self.version), exist_ok=True)
-
-            # make the directory for tensorboardx stuff
-            os.makedirs(self.get_tensorboardx_path(self.name, self.version), exist_ok=True)
-        except Exception as e:
-            # file already exists (likely written by another exp. In this case disable the experiment
-            self.debug = True
+        self.version = version
+        self.exp_hash = '{}_v{}'.format(self.name, version)
 
 
     def __get_last_experiment_version(self):
@@ -253,6 +361,9 @@ class Experiment(SummaryWriter):
         except Exception as e:
             return -1
 
+    def __get_metrics_file_path(self):
+        return '{}/metrics.{}'.format(self.get_data_path(self.name, self.version), self.metrics_format)
+
     def __get_log_name(self):
         exp_cache_file = self.get_data_path(self.name, self.version)
         return '{}/meta.experiment'.format(exp_cache_file)
@@ -273,10 +384,13 @@ class Experiment(SummaryWriter):
         # parse tags
         for k, v in tag_dict.items():
             self.tags[k] = v
+        self._tags_dirty = True
+
+        # the hparams text is written again with the new tags on the next save
+        self.tag_markdown_saved = False
 
         # save if needed
-        if self.autosave == True:
-            self.save()
+        self.__autosave()
 
     def log(self, metrics_dict, global_step=None, walltime=None):
         """
@@ -294,35 +408,51 @@ class Experiment(SummaryWriter):
         if global_step is None:
             global_step = len(self.metrics)
 
+        # tensorboard is only written every tb_log_interval steps
+        write_tfx = global_step % self.tb_log_interval == 0
+
+        # plain numbers share one summary instead of one event each
+        summary_values = []
         new_metrics_dict = metrics_dict.copy()
         for k, v in metrics_dict.items():
             if isinstance(v, dict):
-                self.add_scalars(main_tag=k, tag_scalar_dict=v, global_step=global_step, walltime=walltime)
+                if write_tfx:
+                    self.add_scalars(main_tag=k, tag_scalar_dict=v, global_step=global_step, walltime=walltime)
                 tmp_metrics_dict = new_metrics_dict.pop(k)
                 new_metrics_dict.update(tmp_metrics_dict)
+            elif not write_tfx or self.__image_extension(k) is not None:
+                # images go to the media folder on save, not to tensorboard
+                continue
+            elif isinstance(v, numbers.Real):
+                summary_values.append(Summary.Value(tag=k, simple_value=float(v)))
             else:
                 self.add_scalar(tag=k, scalar_value=v, global_step=global_step, walltime=walltime)
 
+        if len(summary_values) > 0:
+            self._get_file_writer().add_summary(Summary(value=summary_values), global_step, walltime)
+
         metrics_dict = new_metrics_dict
 
         # timestamp
+        # a float is cheaper to take than a date string, save formats it
         if 'created_at' not in metrics_dict:
-            metrics_dict['created_at'] = str(datetime.utcnow())
+            metrics_dict['created_at'] = _LogTime(time.time())
 
         self.__convert_numpy_types(metrics_dict)
 
         self.metrics.append(metrics_dict)
 
-        if self.autosave:
+        self.__autosave()
+
+    def __autosave(self):
+        if self.autosave and time.monotonic() - self._last_save >= self.autosave_interval_secs:
             self.save()
 
     def __convert_numpy_types(self, metrics_dict):
+        # numpy scalars of any dtype become the matching python type
         for k, v in metrics_dict.items():
-            if v.__class__.__name__ == 'float32':
-                metrics_dict[k] = float(v)
-
-            if v.__class__.__name__ == 'float64':
-                metrics_dict[k] = float(v)
+            if isinstance(v, np.generic):
+                metrics_dict[k] = v.item()
 
     def save(self):
         """
@@ -330,46 +460,211 @@ class Experiment(SummaryWriter):
         :return:
         """
         if self.debug or self.rank > 0: return
+        self._last_save = time.monotonic()
+
+        metrics_file_path = self.__get_metrics_file_path()
+        meta_tags_path = self.get_data_path(self.name, self.version) + '/meta_tags.json'
+
+        obj = None
+        if self._meta_dirty:
+            obj = {
+                'name': self.name,
+                'version': self.version,
+                'tags_path': meta_tags_path,
+                'metrics_path': metrics_file_path,
+                'autosave': self.autosave,
+                'description': self.description,
+                'created_at': self.created_at,
+                'exp_hash': self.exp_hash
+            }
+            self._meta_dirty = False
+
+        tags = None
+        if self._tags_dirty:
+            tags = dict(self.tags)
+            self._tags_dirty = False
+
+        # the io thread gets the rows logged since the last save, taken once here
+        # so logging can go on meanwhile. Start over if the list shrank
+        start = self._metrics_queued if self._metrics_queued <= len(self.metrics) else 0
+        new_metrics = self.metrics[start:]
+        self._metrics_queued = start + len(new_metrics)
+
+        # format the timestamps taken by log
+        for metric in new_metrics:
+            created_at = metric.get('created_at')
+            if type(created_at) is _LogTime:
+                metric['created_at'] = created_at.isoformat()
 
+        # until hparam plugin is fixed, generate hparams as text
+        if not self.tag_markdown_saved and len(self.tags) > 0:
+            self.tag_markdown_saved = True
+            self.add_text('hparams', self.__generate_tfx_meta_log())
+
+        try:
+            self._save_future = self._io_pool.submit(self.__write_files_async, start, new_metrics, obj, tags)
+        except RuntimeError:
+            # the io thread is gone after close or once the interpreter is shutting down
+            self.__write_files(start, new_metrics, obj, tags)
+
+    def __write_files_async(self, start, new_metrics, obj, tags):
+        """
+        Runs __write_files on the io thread. Keeps the first error for flush to
+        raise since the future of a failed save is replaced by the next save
+        :return:
+        """
+        try:
+            self.__write_files(start, new_metrics, obj, tags)
+        except Exception as e:
+            if self._save_error is None:
+                self._save_error = e
+
+    def __write_files(self, start, new_metrics, obj, tags):
+        """
+        Writes a snapshot taken by save to disk
+        :param start: index of the first new metric in self.metrics
+        :param new_metrics: the metrics logged since the last save
+        :param obj: meta data, None when unchanged
+        :param tags: copy of the tags, None when unchanged
+        :return:
+        """
+        try:
+            self.__write_snapshot(start, new_metrics, obj, tags)
+        except Exception:
+            # what didn't make it to disk is written again by the next save.
+            # metrics catch up on their own since _metrics_written didn't move
+            if obj is not None:
+                self._meta_dirty = True
+            if tags is not None:
+                self._tags_dirty = True
+            raise
+
+    def __write_snapshot(self, start, new_metrics, obj, tags):
         # save images and replace the image array with the
         # file name
-        self.__save_images(self.metrics)
-        metrics_file_path = self.get_data_path(self.name, self.version) + '/metrics.csv'
+        self.__save_images(start, new_metrics)
+        metrics_file_path = self.__get_metrics_file_path()
         meta_tags_path = self.get_data_path(self.name, self.version) + '/meta_tags.json'
 
-        obj = {
-            'name': self.name,
-            'version': self.version,
-            'tags_path': meta_tags_path,
-            'metrics_path': metrics_file_path,
-            'autosave': self.autosave,
-            'description': self.description,
-            'created_at': self.created_at,
-            'exp_hash': self.exp_hash
-        }
-
         # save the experiment meta file
-        with atomic_write(self.__get_log_name()) as tmp_path:
-            with open(tmp_path, 'w') as file:
-                json.dump(obj, file, ensure_ascii=False)
+        if obj is not None:
+            with atomic_write(self.__get_log_name()) as tmp_path:
+                dump_json(obj, tmp_path)
 
         # save the metatags file
-        with atomic_write(meta_tags_path) as tmp_path:
-            f = Path(tmp_path)
-            json.dump(self.tags, f.open(mode="w"))
+        if tags is not None:
+            with atomic_write(meta_tags_path) as tmp_path:
+                dump_json(tags, tmp_path)
 
         # save the metrics data
-        df = pd.DataFrame(self.metrics)
-        with atomic_write(metrics_file_path) as tmp_path:
-            df.to_csv(tmp_path, index=False)
+        if self.metrics_format == 'parquet':
+            self.__save_metrics_parquet(metrics_file_path, start, new_metrics)
+        else:
+            self.__save_metrics(metrics_file_path, start, new_metrics)
 
         # write new vals to disk
-        self.flush()
+        self.__flush_writers()
 
-        # until hparam plugin is fixed, generate hparams as text
-        if not self.tag_markdown_saved and len(self.tags) > 0:
-            self.tag_markdown_saved = True
-            self.add_text('hparams', self.__generate_tfx_meta_log())
+    def __save_metrics(self, metrics_file_path, start, new_metrics):
+        """
+        Appends the metrics logged since the last save to the csv. The whole
+        file is only rewritten when a new column shows up
+        :param metrics_file_path:
+        :param start: index of the first new metric in self.metrics
+        :param new_metrics:
+        :return:
+        """
+        new_keys = {k for metric in new_metrics for k in metric}
+
+        rewrite = (
+            self._metrics_columns is None
+            or start != self._metrics_written
+            or not new_keys.issubset(self._metrics_columns)
+        )
+        if rewrite:
+            # every row up to the new ones, earlier rows are already final
+            metrics = self.metrics[:start] + new_metrics
+
+            # columns in the order they first show up
+            columns = list(dict.fromkeys(k for metric in metrics for k in metric))
+            with atomic_write(metrics_file_path) as tmp_path:
+                with open(tmp_path, 'w', newline='') as file:
+                    writer = _metrics_csv_writer(file, columns)
+                    writer.writeheader()
+                    writer.writerows(metrics)
+            self._metrics_columns = columns
+
+            # the handle still points at the replaced file
+            self.__close_csv()
+
+        elif len(new_metrics) > 0:
+            if self._csv_fh is None:
+                self._csv_fh = open(metrics_file_path, 'a', newline='')
+                self._csv_writer = _metrics_csv_writer(self._csv_fh, self._metrics_columns)
+            self._csv_writer.writerows(new_metrics)
+            self._csv_fh.flush()
+
+        self._metrics_written = start + len(new_metrics)
+
+    def __close_csv(self):
+        if self._csv_fh is not None:
+            self._csv_fh.close()
+        self._csv_fh = None
+        self._csv_writer = None
+
+    def __save_metrics_parquet(self, metrics_file_path, start, new_metrics):
+        """
+        Writes the metrics logged since the last save as a new row group of
+        the open parquet file. The file is rewritten when the rows don't fit its schema
+        :param metrics_file_path:
+        :param start: index of the first new metric in self.metrics
+        :param new_metrics:
+        :return:
+        """
+        import pyarrow.parquet as pq
+
+        new_keys = {k for metric in new_metrics for k in metric}
+
+        rewrite = (
+            self._pq_writer is None
+            or start != self._metrics_written
+            or not new_keys.issubset(self._metrics_columns)
+        )
+        if not rewrite and len(new_metrics) > 0:
+            try:
+                table = _table_with_schema(_metrics_table(new_metrics), self._pq_writer.schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                # e.g. a float in a column that only held ints so far
+                rewrite = True
+            else:
+                self._pq_writer.write_table(table)
+
+        if rewrite and start + len(new_metrics) > 0:
+            # every row up to the new ones, earlier rows are already final
+            metrics = self.metrics[:start] + new_metrics
+
+            self.__close_parquet()
+            table = _metrics_table(metrics)
+
+            # the rows go to a tmp file that replaces the metrics file once the writer
+            # is closed, so a crash before that leaves the last complete file in place
+            with contextlib.ExitStack() as stack:
+                tmp_path = stack.enter_context(atomic_write(metrics_file_path))
+                pq_writer = pq.ParquetWriter(tmp_path, table.schema, compression='zstd')
+                stack.callback(pq_writer.close)
+                pq_writer.write_table(table)
+                self._pq_commit = stack.pop_all()
+            self._pq_writer = pq_writer
+            self._metrics_columns = table.column_names
+
+        self._metrics_written = start + len(new_metrics)
+
+    def __close_parquet(self):
+        # closes the writer, then renames the tmp file over the metrics file
+        if self._pq_commit is not None:
+            self._pq_commit.close()
+        self._pq_commit = None
+        self._pq_writer = None
 
     def __generate_tfx_meta_log(self):
         header = f'''###### {self.name}, version {self.version}\n---\n'''
@@ -379,92 +674,112 @@ class Experiment(SummaryWriter):
         params = f'''##### Hyperparameters\n'''
 
         row_header = '''parameter|value\n-|-\n'''
-        rows = [row_header]
-        for k, v in self.tags.items():
-            row = f'''{k}|{v}\n'''
-            rows.append(row)
-
-        all_rows = [
-            header,
-            desc,
-            params
-        ]
-        all_rows.extend(rows)
-        mkdown_log = ''.join(all_rows)
+        rows = '\n'.join(f'''{k}|{v}''' for k, v in self.tags.items())
+        mkdown_log = f'''{header}{desc}{params}{row_header}{rows}\n'''
         return mkdown_log
 
-    def __save_images(self, metrics):
+    def __save_images(self, start, new_metrics):
         """
         Save tags that have a png_ prefix (as images)
         and replace the meta tag with the file name
-        :param metrics:
+        :param start: index of the first new metric in self.metrics
+        :param new_metrics:
         :return:
         """
-        # iterate all metrics and find keys with a specific prefix
-        for i, metric in enumerate(metrics):
+        # iterate the new metrics and find keys with a specific prefix.
+        # older ones already hold file paths, except for the rows of a failed save
+        first = min(self._metrics_written, start)
+        to_write = []
+        for i, metric in enumerate(self.metrics[first:start] + new_metrics, first):
             for k, v in metric.items():
                 # if the prefix is a png, save the image and replace the value with the path
-                img_extension = None
-                img_extension = 'png' if 'png_' in k else img_extension
-                img_extension = 'jpg' if 'jpg' in k else img_extension
-                img_extension = 'jpeg' if 'jpeg' in k else img_extension
+                img_extension = self.__image_extension(k)
 
-                if img_extension is not None:
+                if img_extension is not None and type(v) is not str:
                     # determine the file name
                     img_name = '_'.join(k.split('_')[1:])
                     save_path = self.get_media_path(self.name, self.version)
                     save_path = '{}/{}_{}.{}'.format(save_path, img_name, i, img_extension)
+                    to_write.append((metric, k, save_path, v))
+
+        # encoding releases the GIL, so the images are written in parallel
+        if len(to_write) > 1:
+            nb_threads = min(8, len(to_write), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=nb_threads) as pool:
+                list(pool.map(lambda img: imwrite(img[2], img[3]), to_write))
+        else:
+            for _, _, save_path, img in to_write:
+                imwrite(save_path, img)
 
-                    # save image to disk
-                    if type(metric[k]) is not str:
-                        imwrite(save_path, metric[k])
+        # replace the images in the metrics with the file paths once they are all on
+        # disk, so a failed save keeps the arrays for the next one
+        for metric, k, save_path, _ in to_write:
+            metric[k] = save_path
 
-                    # replace the image in the metric with the file path
-                    metric[k] = save_path
+    def __image_extension(self, key):
+        if key not in self._img_extensions:
+            self._img_extensions[key] = _image_extension(key)
+        return self._img_extensions[key]
 
     def __load(self):
         # load .experiment file
-        with open(self.__get_log_name(), 'r') as file:
-            data = json.load(file)
-            self.name = data['name']
-            self.version = data['version']
-            self.autosave = data['autosave']
-            self.created_at = data['created_at']
-            self.description = data['description']
-            self.exp_hash = data['exp_hash']
+        data = load_json(self.__get_log_name())
+        self.name = data['name']
+        self.version = data['version']
+        self.autosave = data['autosave']
+        self.created_at = data['created_at']
+        self.description = data['description']
+        self.exp_hash = data['exp_hash']
 
         # load .tags file
         meta_tags_path = Path(self.get_data_path(self.name, self.version) + '/meta_tags.json')
         try:
-            tags = json.load(meta_tags_path.open())
+            tags = load_json(meta_tags_path)
         except ValueError: # failed to decode json
             tags = {}
         self.tags = tags
+        self._meta_dirty = False
+        self._tags_dirty = False
         # for d in self.tags_list:
         #     k, v = d['key'], d['value']
         #     self.tags[k] = v
 
-        # load metrics
-        metrics_file_path = self.get_data_path(self.name, self.version) + '/metrics.csv'
-        try:
-            df = pd.read_csv(metrics_file_path)
-            self.metrics = df.to_dict(orient='records')
-
-            # remove nans
-            for metric in self.metrics:
-                to_delete = []
-                for k, v in metric.items():
-                    try:
-                        if np.isnan(v):
-                            to_delete.append(k)
-                    except Exception as e:
-                        pass
-
-                for k in to_delete:
-                    del metric[k]
-        except Exception as e:
-            # metrics was empty...
-            self.metrics = []
+        # load metrics in the format they were saved in
+        metrics_path = data.get('metrics_path', '')
+        if metrics_path.endswith('.parquet'):
+            self.metrics_format = 'parquet'
+        elif metrics_path.endswith('.csv'):
+            self.metrics_format = 'csv'
+
+        metrics_file_path = self.__get_metrics_file_path()
+        if not os.path.exists(metrics_file_path):
+            # nothing was saved yet
+            metrics, columns = [], None
+        else:
+            try:
+                if self.metrics_format == 'parquet':
+                    metrics, columns = read_metrics_parquet(metrics_file_path)
+                else:
+                    metrics, columns = read_metrics_csv(metrics_file_path)
+            except Exception as e:
+                # e.g. a parquet file without footer after the run was killed. The next
+                # save would replace it, so move it out of the way and start a new one
+                metrics, columns = [], None
+                moved_path = metrics_file_path + '.unreadable'
+                nb = 1
+                while os.path.exists(moved_path):
+                    moved_path = '{}.unreadable{}'.format(metrics_file_path, nb)
+                    nb += 1
+                if self.rank == 0:
+                    os.rename(metrics_file_path, moved_path)
+                warnings.warn(
+                    'Can\'t read the metrics file {} ({}). It was moved to {}, '
+                    'new metrics are saved to a new file'.format(metrics_file_path, e, moved_path))
+
+        self.metrics = metrics
+        self._metrics_written = len(metrics)
+        self._metrics_queued = len(metrics)
+        self._metrics_columns = columns
 
     def get_data_path(self, exp_name, exp_version):
         """
@@ -472,10 +787,15 @@ class Experiment(SummaryWriter):
         :param path:
         :return:
         """
-        if self.no_save_dir:
-            return os.path.join(_ROOT, 'test_tube_data', exp_name, 'version_{}'.format(exp_version))
-        else:
-            return os.path.join(_ROOT, exp_name, 'version_{}'.format(exp_version))
+        # _ROOT is in the key because a later Experiment with a save_dir moves it
+        key = ('data', _ROOT, exp_name, exp_version)
+        if key not in self._path_cache:
+            if self.no_save_dir:
+                path = os.path.join(_ROOT, 'test_tube_data', exp_name, 'version_{}'.format(exp_version))
+            else:
+                path = os.path.join(_ROOT, exp_name, 'version_{}'.format(exp_version))
+            self._path_cache[key] = path
+        return self._path_cache[key]
 
     def get_media_path(self, exp_name, exp_version):
         """
@@ -483,7 +803,10 @@ class Experiment(SummaryWriter):
         :param path:
         :return:
         """
-        return os.path.join(self.get_data_path(exp_name, exp_version), 'media')
+        key = ('media', _ROOT, exp_name, exp_version)
+        if key not in self._path_cache:
+            self._path_cache[key] = os.path.join(self.get_data_path(exp_name, exp_version), 'media')
+        return self._path_cache[key]
 
     def get_tensorboardx_path(self, exp_name, exp_version):
         """
@@ -491,7 +814,10 @@ class Experiment(SummaryWriter):
         :param path:
         :return:
         """
-        return os.path.join(self.get_data_path(exp_name, exp_version), 'tf')
+        key = ('tf', _ROOT, exp_name, exp_version)
+        if key not in self._path_cache:
+            self._path_cache[key] = os.path.join(self.get_data_path(exp_name, exp_version), 'tf')
+        return self._path_cache[key]
 
     def get_tensorboardx_scalars_path(self, exp_name, exp_version):
         """
@@ -512,34 +838,82 @@ class Experiment(SummaryWriter):
             return TTDummyFileWriter()
 
         if self.all_writers is None or self.file_writer is None:
+            self.file_writer = self.__acquire_file_writer()
+            self.all_writers = {self.file_writer.get_logdir(): self.file_writer}
+        return self.file_writer
+
+    def __acquire_file_writer(self):
+        key = (os.getpid(), self.log_dir)
+        with Experiment._writer_cache_lock:
+            cached = Experiment._writer_cache.get(key)
+            if cached is not None:
+                cached[1] += 1
+                return cached[0]
+
             if self.purge_step is not None:
                 most_recent_step = self.purge_step
-                self.file_writer = FileWriter(self.log_dir, self.max_queue,
-                                          self.flush_secs, self.filename_suffix)
-                self.file_writer.debug = self.debug
-                self.file_writer.rank = self.rank
+                file_writer = FileWriter(self.log_dir, self.max_queue,
+                                         self.flush_secs, self.filename_suffix)
+                file_writer.debug = self.debug
+                file_writer.rank = self.rank
 
-                self.file_writer.add_event(
+                file_writer.add_event(
                     Event(step=most_recent_step, file_version='brain.Event:2'))
-                self.file_writer.add_event(
+                file_writer.add_event(
                     Event(step=most_recent_step, session_log=SessionLog(status=SessionLog.START)))
             else:
-                self.file_writer = FileWriter(self.log_dir, self.max_queue,
-                                          self.flush_secs, self.filename_suffix)
-            self.all_writers = {self.file_writer.get_logdir(): self.file_writer}
-        return self.file_writer
+                file_writer = FileWriter(self.log_dir, self.max_queue,
+                                         self.flush_secs, self.filename_suffix)
+
+            Experiment._writer_cache[key] = [file_writer, 1]
+            return file_writer
+
+    def __release_file_writer(self):
+        """
+        Drops this experiment's use of the shared FileWriter. Only the last
+        experiment using it lets SummaryWriter.close close it
+        :return:
+        """
+        if self.all_writers is None or self.file_writer is None:
+            return
+
+        key = (os.getpid(), self.log_dir)
+        with Experiment._writer_cache_lock:
+            cached = Experiment._writer_cache.get(key)
+            if cached is None or cached[0] is not self.file_writer:
+                return
+
+            cached[1] -= 1
+            if cached[1] > 0:
+                # other experiments still write to it
+                self.file_writer.flush()
+                del self.all_writers[self.file_writer.get_logdir()]
+                self.file_writer = None
+            else:
+                del Experiment._writer_cache[key]
 
 
     def __str__(self):
         return 'Exp: {}, v: {}'.format(self.name, self.version)
 
     def __hash__(self):
-        return 'Exp: {}, v: {}'.format(self.name, self.version)
+        return hash((self.name, self.version))
 
     def flush(self):
         if self.rank > 0:
             return
 
+        # wait for the saves queued on the io thread, they run in order
+        if self._save_future is not None:
+            self._save_future.result()
+
+        error, self._save_error = self._save_error, None
+        if error is not None:
+            raise error
+
+        self.__flush_writers()
+
+    def __flush_writers(self):
         if self.all_writers is None:
             return  # ignore double close
 
@@ -547,6 +921,15 @@ class Experiment(SummaryWriter):
             writer.flush()
 
 
+def _reset_writer_cache_lock():
+    # another thread of the parent may have held the lock when it forked
+    Experiment._writer_cache_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_writer_cache_lock)
+
+
 class TTDummyFileWriter(object):
 
     def add_summary(self, summary, global_step=None, walltime=None):
@@ -562,13 +945,15 @@ class TTDummyFileWriter(object):
 
 
 @contextlib.contextmanager
-def atomic_write(dst_path):
+def atomic_write(dst_path, durable=False):
     """A context manager to simplify atomic writing.
 
     Usage:
     >>> with atomic_write(dst_path) as tmp_path:
     >>>     # write to tmp_path
     >>> # Here tmp_path renamed to dst_path, if no exception happened.
+
+    With durable=True the file and the rename are fsynced, so they survive a crash.
     """
     tmp_path = str(dst_path) + '.tmp'
     try:
@@ -579,15 +964,165 @@ def atomic_write(dst_path):
         raise
     else:
         # If everything is fine, move tmp file to the destination.
-        shutil.move(tmp_path, str(dst_path))
+        # tmp_path is next to dst_path, so this is a single atomic rename
+        if durable:
+            _fsync(tmp_path, os.O_RDWR)
+        os.replace(tmp_path, str(dst_path))
+        if durable and hasattr(os, 'O_DIRECTORY'):
+            _fsync(os.path.dirname(os.path.abspath(str(dst_path))), os.O_RDONLY | os.O_DIRECTORY)
+
+
+def _fsync(path, flags):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _LogTime(float):
+    """
+    time.time() taken by log(). Tells the timestamps log() made apart from
+    created_at values passed in by the user
+    """
+
+    def isoformat(self):
+        # same format str(datetime.utcnow()) gives
+        return str(datetime.fromtimestamp(self, timezone.utc).replace(tzinfo=None))
+
+
+def _image_extension(key):
+    """
+    Metrics with png, jpg or jpeg in their key are images
+    :param key:
+    :return: the file extension or None
+    """
+    for marker, img_extension in _IMG_MARKERS:
+        if marker in key:
+            return img_extension
+    return None
+
+
+def _metrics_csv_writer(file, columns):
+    # same layout pandas wrote: empty cells for missing keys, \n line endings
+    return csv.DictWriter(file, fieldnames=columns, restval='', extrasaction='ignore', lineterminator='\n')
+
+
+def read_metrics_csv(path):
+    """
+    Reads a metrics.csv back into a list of dicts, leaving out the empty cells
+    :param path:
+    :return: (metrics, columns)
+    """
+    # a save before anything was logged leaves only an empty header line
+    with open(path, newline='') as file:
+        if not file.readline().strip():
+            return [], []
+
+    if pacsv is not None:
+        # created_at stays the string it was logged as instead of becoming a timestamp
+        options = pacsv.ConvertOptions(column_types={'created_at': pa.string()}, strings_can_be_null=True)
+        table = pacsv.read_csv(path, convert_options=options)
+        metrics = [{k: v for k, v in row.items() if v is not None} for row in table.to_pylist()]
+        return metrics, table.column_names
+
+    df = pd.read_csv(path)
+    metrics = df.to_dict(orient='records')
+
+    # remove nans
+    for metric in metrics:
+        to_delete = []
+        for k, v in metric.items():
+            try:
+                if np.isnan(v):
+                    to_delete.append(k)
+            except Exception as e:
+                pass
+
+        for k in to_delete:
+            del metric[k]
+
+    return metrics, list(df.columns)
+
+
+def _metrics_table(metrics):
+    # from_pylist only looks at the keys of the first row
+    columns = dict.fromkeys(k for metric in metrics for k in metric)
+    return pa.Table.from_pydict({k: [metric.get(k) for metric in metrics] for k in columns})
+
+
+def _table_with_schema(table, schema):
+    # safe casts, a float doesn't get truncated to fit an int column
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def read_metrics_parquet(path):
+    """
+    Reads a metrics.parquet back into a list of dicts, leaving out the empty cells
+    :param path:
+    :return: (metrics, columns)
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    metrics = [{k: v for k, v in row.items() if v is not None} for row in table.to_pylist()]
+    return metrics, table.column_names
+
+
+def dump_json(obj, path):
+    """
+    Writes obj as utf-8 json, with orjson when it's installed
+    :param obj:
+    :param path:
+    :return:
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. ints wider than 64 bits, stdlib json still handles those
+            data = None
+
+        if data is not None:
+            with open(path, 'wb') as file:
+                file.write(data)
+            return
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(obj, file, ensure_ascii=False)
+
+
+def load_json(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # files written by stdlib json can hold NaN or Infinity
+            pass
+    return json.loads(data)
 
 
 def find_last_experiment_version(path):
     last_version = -1
-    for f in os.listdir(path):
-        if 'version_' in f:
-            file_parts = f.split('_')
-            version = int(file_parts[-1])
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # scandir knows the entry type without an extra stat
+            if not entry.name.startswith('version_') or not entry.is_dir():
+                continue
+
+            try:
+                version = int(entry.name[len('version_'):])
+            except ValueError:
+                continue
             last_version = max(last_version, version)
     return last_version
 
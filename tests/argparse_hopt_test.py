@@ -1,8 +1,243 @@
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import time
+
 import pytest
 
+from test_tube.argparse_hopt import HyperOptArgumentParser, _GpuIdSlots, _LokyPool, _init_gpu_worker
+
+
+# train functions are sent to the worker processes so they live at module level
+def train_cpu(trial_params):
+    return trial_params.nb_layers * 10
+
+
+def train_fork(trial_params, worker_nb):
+    with open(os.path.join(trial_params.out_dir, str(trial_params.trial_nb)), 'w') as f:
+        f.write(str(worker_nb))
+
+    # the worker moves on to the next trial instead of leaving the sweep
+    if trial_params.trial_nb == 0:
+        sys.exit(1)
+
+
+def train_gpu(trial_params, gpu_ids):
+    start = time.monotonic()
+    time.sleep(0.05)
+    return gpu_ids, os.environ['CUDA_VISIBLE_DEVICES'], os.getpid(), start, time.monotonic()
+
 
 def test_hello():
     assert 4==4
 
+
+def test_opt_range_seed():
+    def sample(seed):
+        parser = HyperOptArgumentParser(seed=seed)
+        parser.opt_range('--lr', default=0.1, type=float, tunable=True, low=1e-4, high=1e-1, nb_samples=5)
+        parser.opt_range('--wd', default=0.1, type=float, tunable=True, low=1e-4, high=1e-1, nb_samples=5,
+                         log_base=10)
+        parser.opt_range('--layers', default=2, type=int, tunable=True, low=1, high=10, nb_samples=5)
+        return [list(parser.opt_args[k].opt_values) for k in ('--lr', '--wd', '--layers')]
+
+    assert sample(7) == sample(7)
+    assert sample(7) != sample(8)
+
+
+def test_opt_range_log_scale():
+    parser = HyperOptArgumentParser(seed=0)
+    parser.opt_range('--lr', default=0.1, type=float, tunable=True, low=1e-5, high=1e-1, nb_samples=20,
+                     log_base=10)
+    values = parser.opt_args['--lr'].opt_values
+
+    assert len(values) == 20
+    assert all(1e-5 <= v <= 1e-1 for v in values)
+
+
+def test_opt_range_log_scale_pooled():
+    parser = HyperOptArgumentParser(seed=0)
+    parser.opt_range('--lr', default=0.1, type=float, tunable=True, low=1e-5, high=1e-1, nb_samples=4,
+                     log_base=10)
+    parser.opt_range('--wd', default=0.1, type=float, tunable=True, low=1e-3, high=1, nb_samples=6,
+                     log_base=2)
+    lr = parser.opt_args['--lr'].opt_values
+    wd = parser.opt_args['--wd'].opt_values
+
+    assert len(lr) == 4 and all(1e-5 <= v <= 1e-1 for v in lr)
+    assert len(wd) == 6 and all(1e-3 <= v <= 1 for v in wd)
+
+    # ranges declared later are drawn on their own
+    parser.opt_range('--eps', default=0.1, type=float, tunable=True, low=1e-8, high=1e-6, nb_samples=3,
+                     log_base=10)
+    eps = parser.opt_args['--eps'].opt_values
+    assert len(eps) == 3 and all(1e-8 <= v <= 1e-6 for v in eps)
+    assert list(parser.opt_args['--lr'].opt_values) == list(lr)
+
+
+def test_generate_trials_after_new_opt_arg():
+    parser = HyperOptArgumentParser(strategy='grid_search')
+    parser.opt_list('--batch-size', default=32, type=int, tunable=True, options=[16, 32])
+    parser.parse_args([])
+    assert len(parser.generate_trials(None)) == 2
+
+    parser.opt_list('--nb_layers', default=2, type=int, tunable=True, options=[2, 4, 8])
+    parser.parse_args([])
+    trials = parser.generate_trials(None)
+    assert len(trials) == 6
+    assert {t.batch_size for t in trials} == {16, 32}
+
+
+def test_random_search_trials():
+    parser = HyperOptArgumentParser(strategy='random_search')
+    parser.opt_list('--nb_layers', default=2, type=int, tunable=True, options=[2, 4, 8])
+    parser.opt_list('--activation', default='relu', type=str, tunable=True, options=['relu', 'tanh'])
+    parser.add_argument('--epochs', default=10, type=int)
+    parser.parse_args([])
+    trials = parser.generate_trials(10)
+
+    # only 6 unique combinations exist
+    assert len(trials) == 6
+    assert len({(t.nb_layers, t.activation) for t in trials}) == 6
+    assert all(t.epochs == 10 for t in trials)
+
+
+def test_namespace_parser_methods():
+    parser = HyperOptArgumentParser(strategy='grid_search')
+    parser.opt_list('--nb_layers', default=2, type=int, tunable=True, options=[2, 4])
+    hparams = parser.parse_args([])
+
+    # methods are reachable but are not hyperparameters
+    assert 'trials' not in vars(hparams)
+    assert 'generate_trials' not in str(hparams)
+    assert [t.nb_layers for t in hparams.trials(2)] == [2, 4]
+    assert len(hparams.generate_trials(2)) == 2
+
+    restored = pickle.loads(pickle.dumps(hparams))
+    assert vars(restored) == vars(hparams)
+    with pytest.raises(AttributeError):
+        restored.trials
+
+
+def test_trial_nb_is_reserved():
+    parser = HyperOptArgumentParser(strategy='grid_search')
+    parser.add_argument('--trial_nb', default=0, type=int)
+    hparams = parser.parse_args([])
+
+    with pytest.raises(ValueError):
+        hparams.optimize_parallel_cpu(abs, nb_trials=1, nb_workers=1, backend='thread')
+    parser.close()
+
+
+def test_loky_pool_bounds_pending_tasks():
+    pytest.importorskip('loky')
+    pulled = []
+
+    def tasks():
+        for i in range(-20, 0):
+            pulled.append(i)
+            yield i
+
+    pool = _LokyPool(2)
+    results = pool.imap_unordered(abs, tasks())
+    first = next(results)
+
+    # the first wait returns at most the whole window, which is then refilled
+    assert len(pulled) <= 2 * pool.max_pending
+    assert sorted([first] + list(results)) == list(range(1, 21))
+    pool.close()
+    pool.join()
+
+
+def _sweep_parser(nb_trials):
+    parser = HyperOptArgumentParser(strategy='grid_search')
+    parser.opt_list('--nb_layers', default=1, type=int, tunable=True, options=list(range(nb_trials)))
+    return parser
+
+
+@pytest.mark.parametrize('backend', ['stdlib', 'thread'])
+def test_optimize_parallel_cpu(backend):
+    with _sweep_parser(8) as parser:
+        hparams = parser.parse_args([])
+        results = hparams.optimize_parallel_cpu(train_cpu, nb_trials=8, nb_workers=2, backend=backend)
+
+    assert sorted(trial.trial_nb for trial, _ in results) == list(range(8))
+    assert all(result == trial.nb_layers * 10 for trial, result in results)
+
+
+def test_pool_is_reused_for_the_same_train_function():
+    with _sweep_parser(2) as parser:
+        hparams = parser.parse_args([])
+        hparams.optimize_parallel_cpu(train_cpu, nb_trials=2, nb_workers=2, backend='thread')
+        pool = parser.pool
+        hparams.optimize_parallel_cpu(train_cpu, nb_trials=2, nb_workers=2, backend='thread')
+        assert parser.pool is pool
+
+    assert parser.pool is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_optimize_parallel(tmp_path):
+    parser = _sweep_parser(6)
+    parser.add_argument('--out_dir', default=str(tmp_path))
+    hparams = parser.parse_args([])
+    hparams.optimize_parallel(train_fork, nb_trials=6, nb_parallel=2)
+
+    # every trial ran once, on one of the workers
+    assert sorted(int(p.name) for p in tmp_path.iterdir()) == list(range(6))
+    assert {p.read_text() for p in tmp_path.iterdir()} <= {'0', '1'}
+
+
+@pytest.mark.parametrize('max_trials_per_worker', [None, 1])
+def test_optimize_parallel_gpu_batches(max_trials_per_worker):
+    with _sweep_parser(8) as parser:
+        hparams = parser.parse_args([])
+        results = hparams.optimize_parallel_gpu(
+            train_gpu,
+            gpu_ids=['0', '1'],
+            batch_per_gpu=2,
+            max_trials_per_worker=max_trials_per_worker
+        )
+
+    assert sorted(trial.trial_nb for trial, _ in results) == list(range(8))
+    runs = [result for _, result in results]
+    assert all(gpu_ids == visible for gpu_ids, visible, _, _, _ in runs)
+
+    # trials running at the same time never share a gpu id set
+    for i, (gpu_ids, _, pid, start, end) in enumerate(runs):
+        for other_gpu_ids, _, other_pid, other_start, other_end in runs[i + 1:]:
+            if pid != other_pid and start < other_end and other_start < end:
+                assert gpu_ids != other_gpu_ids
+
+
+def test_gpu_id_slots_are_exclusive():
+    slots = _GpuIdSlots(['0', '1, 2'])
+    first, second = slots.claim(), slots.claim()
+    assert first != second
+
+    # a third claim waits until a set is released
+    claimed = []
+    waiter = threading.Thread(target=lambda: claimed.append(slots.claim()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+
+    slots.release(first)
+    waiter.join(5)
+    assert claimed == [first]
+
+
+def test_pinned_worker_releases_its_gpu_ids_on_exit():
+    slots = _GpuIdSlots(['0'])
+    worker = multiprocessing.Process(target=_init_gpu_worker, args=(slots, True, train_gpu))
+    worker.start()
+    worker.join(5)
+
+    # a replacement worker can pin the same set
+    assert slots.free.acquire(timeout=5)
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
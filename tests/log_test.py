@@ -1,8 +1,244 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
 import pytest
+from imageio import imwrite
+
+from test_tube.log import Experiment, find_last_experiment_version
 
 
 def test_hello():
     assert 4==4
 
+
+def test_save_appends_metrics(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='append')
+    exp.log({'loss': 1.0})
+    exp.save()
+    exp.log({'loss': 0.5})
+    exp.save()
+
+    # a new column forces the header to be rewritten
+    exp.log({'loss': 0.25, 'acc': 0.9})
+    exp.save()
+    exp.close()
+
+    path = exp.get_data_path(exp.name, exp.version) + '/metrics.csv'
+    df = pd.read_csv(path)
+    assert list(df['loss']) == [1.0, 0.5, 0.25]
+    assert isinstance(exp.metrics[0]['created_at'], str)
+    assert pd.to_datetime(df['created_at']).notna().all()
+    assert df['acc'].isna().sum() == 2
+
+    # reloading picks up where the csv left off
+    exp = Experiment(save_dir=str(tmp_path), name='append', version=exp.version)
+    exp.log({'loss': 0.1, 'acc': 0.95})
+    exp.save()
+    exp.close()
+    assert list(pd.read_csv(path)['loss']) == [1.0, 0.5, 0.25, 0.1]
+
+
+def test_autosave_interval(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='throttle', autosave=True, autosave_interval_secs=60)
+    path = exp.get_data_path(exp.name, exp.version) + '/metrics.csv'
+
+    # the first log saves, the next ones wait for the interval
+    exp.log({'loss': 1.0})
+    exp.log({'loss': 0.5})
+    exp.flush()
+    assert len(pd.read_csv(path)) == 1
+
+    # close saves whatever is left
+    exp.close()
+    assert len(pd.read_csv(path)) == 2
+
+
+def test_failed_save_is_raised_and_retried(tmp_path, monkeypatch):
+    failures = [OSError('disk full')]
+
+    def imwrite_failing_once(path, img):
+        if failures:
+            raise failures.pop()
+        imwrite(path, img)
+
+    monkeypatch.setattr('test_tube.log.imwrite', imwrite_failing_once)
+
+    exp = Experiment(save_dir=str(tmp_path), name='fail')
+    exp.tag({'lr': 0.1, 'bad': object()})
+    exp.log({'png_a': np.zeros((4, 4, 3), dtype=np.uint8)})
+    exp.save()
+
+    # a later save doesn't hide the error
+    exp.log({'loss': 1.0})
+    exp.save()
+    with pytest.raises(OSError):
+        exp.flush()
+
+    # the tags weren't written so the next save tries again
+    del exp.tags['bad']
+    exp.save()
+    exp.close()
+    data_path = exp.get_data_path(exp.name, exp.version)
+    assert json.load(open(data_path + '/meta_tags.json')) == {'lr': 0.1}
+
+    # so is the image of the failed save
+    img_path = exp.get_media_path(exp.name, exp.version) + '/a_0.png'
+    assert os.path.exists(img_path)
+    assert pd.read_csv(data_path + '/metrics.csv')['png_a'][0] == img_path
+
+
+def test_log_converts_numpy_scalars(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='numpy')
+    exp.log({'a': np.float16(0.5), 'b': np.int64(3), 'c': np.bool_(True)})
+    exp.close()
+
+    metric = exp.metrics[0]
+    assert type(metric['a']) is float
+    assert type(metric['b']) is int
+    assert type(metric['c']) is bool
+
+
+def test_log_images(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='images')
+    img = np.zeros((4, 4, 3), dtype=np.uint8)
+    exp.log({'png_a': img, 'png_b': img, 'loss': 1.0})
+    exp.log({'png_a': img, 'loss': 0.5})
+    exp.save()
+    exp.close()
+
+    media_path = exp.get_media_path(exp.name, exp.version)
+    assert exp.metrics[1]['png_a'] == '{}/a_1.png'.format(media_path)
+    assert sorted(p.name for p in (tmp_path / 'images' / 'version_0' / 'media').iterdir()) == [
+        'a_0.png', 'a_1.png', 'b_0.png'
+    ]
+
+
+def test_find_last_experiment_version(tmp_path):
+    assert find_last_experiment_version(str(tmp_path)) == -1
+
+    for name in ['version_0', 'version_12', 'version_3', 'version_old']:
+        (tmp_path / name).mkdir()
+    (tmp_path / 'version_99').touch()
+    assert find_last_experiment_version(str(tmp_path)) == 12
+
+
+def test_experiments_share_file_writer(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='shared')
+    exp.save()
+    exp.flush()
+    other = Experiment(save_dir=str(tmp_path), name='shared', version=exp.version)
+    assert other._get_file_writer() is exp._get_file_writer()
+
+    # the writer stays open until the last experiment using it is closed
+    exp.close()
+    other.log({'loss': 1.0})
+    other.close()
+    assert (os.getpid(), other.log_dir) not in Experiment._writer_cache
+    assert len(list((tmp_path / 'shared' / 'version_0' / 'tf').glob('events.*'))) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_forked_child_opens_its_own_file_writer(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='fork')
+    exp.log({'loss': 1.0})
+    exp.save()
+    exp.flush()
+
+    pid = os.fork()
+    if pid == 0:
+        # the cached writer belongs to the parent, its writer thread isn't running here
+        status = 1
+        try:
+            child = Experiment(save_dir=str(tmp_path), name='fork', version=exp.version)
+            child.log({'loss': 0.5})
+            child.flush()
+            child.close()
+            status = 0
+        finally:
+            os._exit(status)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            break
+        time.sleep(0.1)
+    else:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+        pytest.fail('forked child hung on the parent file writer')
+
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    exp.close()
+
+
+def test_save_metrics_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    exp = Experiment(save_dir=str(tmp_path), name='pq', metrics_format='parquet')
+    exp.log({'loss': 1})
+    exp.save()
+    exp.log({'loss': 0.5})
+    exp.save()
+    exp.log({'loss': 0.25, 'acc': 0.9})
+    exp.save()
+    exp.close()
+
+    path = exp.get_data_path(exp.name, exp.version) + '/metrics.parquet'
+    df = pd.read_parquet(path)
+    assert list(df['loss']) == [1.0, 0.5, 0.25]
+
+    # the format is picked up from the saved experiment
+    exp = Experiment(save_dir=str(tmp_path), name='pq', version=exp.version)
+    assert exp.metrics_format == 'parquet'
+    assert [m['loss'] for m in exp.metrics] == [1.0, 0.5, 0.25]
+    exp.close()
+
+
+def test_load_keeps_unreadable_metrics(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    exp = Experiment(save_dir=str(tmp_path), name='broken', metrics_format='parquet')
+    exp.log({'loss': 1.0})
+    exp.save()
+    exp.close()
+
+    # e.g. a run killed before the footer was written
+    path = tmp_path / 'broken' / 'version_0' / 'metrics.parquet'
+    path.write_bytes(path.read_bytes()[:-8])
+    data = path.read_bytes()
+
+    with pytest.warns(UserWarning, match='metrics.parquet'):
+        exp = Experiment(save_dir=str(tmp_path), name='broken', version=0)
+    exp.log({'loss': 0.5})
+    exp.save()
+    exp.close()
+
+    # the experiment goes on in a new file, the old one is kept as is
+    assert (tmp_path / 'broken' / 'version_0' / 'metrics.parquet.unreadable').read_bytes() == data
+    assert list(pd.read_parquet(path)['loss']) == [0.5]
+
+
+def test_load_uses_saved_metrics_format(tmp_path):
+    exp = Experiment(save_dir=str(tmp_path), name='fmt')
+    exp.log({'loss': 1.0})
+    exp.save()
+    exp.close()
+
+    exp = Experiment(save_dir=str(tmp_path), name='fmt', version=0, metrics_format='parquet')
+    assert exp.metrics_format == 'csv'
+    assert [m['loss'] for m in exp.metrics] == [1.0]
+    exp.close()
+
+
+def test_experiment_is_hashable():
+    exp = Experiment(name='hash', debug=True, version=3)
+    assert hash(exp) == hash(('hash', 3))
+    assert exp in {exp}
+
+
 if __name__ == '__main__':
     pytest.main([__file__])